@@ -1,6 +1,6 @@
 # evaluate_model.py
 
-import pandas as pd
+import numpy as np
 from sklearn.metrics import classification_report, accuracy_score, confusion_matrix
 from sklearn.ensemble import IsolationForest
 from joblib import load
@@ -15,35 +15,44 @@ MONGO_URI = "mongodb://localhost:27017"
 client = MongoClient(MONGO_URI)
 collection = client["helicopter_db"]["telemetry_logs"]
 
-# Load latest records
-data = list(collection.find({}, {"_id": 0, "rpm": 1, "fuel_pressure": 1, "fuel_temp": 1, "flow_rate": 1, "label": 1}))
-
-# Convert to DataFrame
-df = pd.DataFrame(data)
-
-# Make sure required columns exist
+# Load latest records straight into a preallocated float32 matrix
 required_columns = ["rpm", "fuel_pressure", "fuel_temp", "flow_rate"]
-if not all(col in df.columns for col in required_columns):
-    raise ValueError("Required fields missing from data!")
+n = collection.count_documents({})
+X = np.empty((n, len(required_columns)), dtype=np.float32)
+labels = np.full(n, -1, dtype=np.int8)  # -1 = no manual label
+
+rows = 0
+cursor = collection.find({}, {"_id": 0, "rpm": 1, "fuel_pressure": 1, "fuel_temp": 1, "flow_rate": 1, "label": 1}).limit(n).batch_size(5000)
+for doc in cursor:
+    # Make sure required columns exist
+    try:
+        X[rows] = (doc["rpm"], doc["fuel_pressure"], doc["fuel_temp"], doc["flow_rate"])
+    except KeyError:
+        raise ValueError("Required fields missing from data!")
+    if "label" in doc:
+        labels[rows] = doc["label"]
+    rows += 1
+X = X[:rows]
+labels = labels[:rows]
 
 # Check if manual labels exist
-has_labels = "label" in df.columns
+labeled = labels != -1
+has_labels = bool(labeled.any())
 
 # Load trained model
 model = load("anomaly_model.joblib")
 
 # Run predictions
-X = df[required_columns]
-y_pred = model.predict(X)
-y_pred = [1 if x == -1 else 0 for x in y_pred]  # 1 = anomaly, 0 = normal
+y_pred = np.where(model.predict(X) == -1, 1, 0).astype(np.int8)  # 1 = anomaly, 0 = normal
 
 if has_labels:
-    y_true = df["label"]
+    y_true = labels[labeled]
+    y_pred_labeled = y_pred[labeled]
     print("\n Supervised Evaluation (Manual Labels Present)")
-    print("Accuracy:", accuracy_score(y_true, y_pred))
-    print("Confusion Matrix:\n", confusion_matrix(y_true, y_pred))
-    print("Classification Report:\n", classification_report(y_true, y_pred))
+    print("Accuracy:", accuracy_score(y_true, y_pred_labeled))
+    print("Confusion Matrix:\n", confusion_matrix(y_true, y_pred_labeled))
+    print("Classification Report:\n", classification_report(y_true, y_pred_labeled))
 else:
     print("\n Unsupervised Evaluation (No Labels)")
-    print(f"Total samples: {len(df)}")
-    print(f"Predicted anomalies: {sum(y_pred)}")
+    print(f"Total samples: {len(X)}")
+    print(f"Predicted anomalies: {int(y_pred.sum())}")
@@ -1,20 +1,24 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-import random
 import time
+import asyncio
 import json
 import threading
+import queue
+import traceback
 import paho.mqtt.client as mqtt
-from pymongo import MongoClient
-from fastapi.encoders import jsonable_encoder
+from pymongo import AsyncMongoClient
+from pymongo.errors import BulkWriteError, ConnectionFailure
 from datetime import datetime,timezone
 import os
 from typing import List
 from bson import ObjectId
 from bson.json_util import dumps
 from sklearn.ensemble import IsolationForest
-from joblib import dump, load
-import pandas as pd
+from joblib import dump, load, parallel_backend
+import hashlib
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import numpy as np 
 from fastapi import Query
 from sendgrid import SendGridAPIClient
@@ -24,14 +28,23 @@ from dotenv import load_dotenv
 from pydantic import BaseModel
 import numpy as np
 from fastapi.responses import StreamingResponse, JSONResponse
-from io import StringIO
+from fastapi.encoders import jsonable_encoder
+from io import BytesIO
 from datetime import timedelta
-from collections import Counter
+
+# Optional: ONNX Runtime inference, falls back to scikit-learn when not installed
+try:
+    import onnxruntime as ort
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+except ImportError:
+    ort = None
+    convert_sklearn = None
 
 
 # MongoDB setup
 MONGO_URI = "mongodb://localhost:27017"
-mongo_client = MongoClient(MONGO_URI)
+mongo_client = AsyncMongoClient(MONGO_URI)
 db = mongo_client["helicopter_db"]
 collection = db["telemetry_logs"]
 collection_tanks = db["fuel_tanks"]
@@ -47,6 +60,10 @@ TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
 ALERT_RECEIVER_PHONE = os.getenv("ALERT_RECEIVER_PHONE")
 ALERT_RECEIVER_EMAIL = os.getenv("ALERT_RECEIVER_EMAIL")
 
+# Alert clients, created once so their HTTP connections are reused
+sendgrid_client = SendGridAPIClient(SENDGRID_API_KEY) if SENDGRID_API_KEY else None
+twilio_client = TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN) if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN else None
+
 
 # FastAPI app setup
 app = FastAPI()
@@ -63,8 +80,25 @@ app.add_middleware(
 BROKER = "broker.hivemq.com"
 PORT = 1883
 TOPIC = "helicopter/fuel"
+PUBLISH_INTERVAL = 10  # seconds between simulated telemetry ticks
 mqtt_client = mqtt.Client()
 
+# Random generator and pre-generated sample pool for the fuel system simulation
+rng = np.random.default_rng()
+SIMULATION_BATCH_SIZE = 64
+simulation_lock = threading.Lock()
+simulated_samples = []
+
+# Batched anomaly inference
+INFERENCE_BATCH_SIZE = 32
+inference_queue = queue.Queue()
+
+# Buffered telemetry writes from the MQTT loop
+TELEMETRY_FLUSH_SIZE = 20
+TELEMETRY_FLUSH_INTERVAL = TELEMETRY_FLUSH_SIZE * PUBLISH_INTERVAL  # seconds; backstop if ticks are skipped
+TELEMETRY_MAX_PENDING = 1000  # oldest records are dropped beyond this while MongoDB is unreachable
+pending_docs = []
+
 fault_to_maintenance = {
     "Fuel pressure drop detected": "🔧 Inspect and replace fuel filters and pressure regulators.",
     "Fuel temperature anomaly": "🛠️ Check fuel cooling systems and thermal insulation.",
@@ -79,28 +113,139 @@ class TankStatusUpdate(BaseModel):
 class FaultRequest(BaseModel):
     type: str
 
-def convert_numpy_to_python(obj):
-    for key, value in obj.items():
-        if isinstance(value, (np.generic,)):
-            obj[key] = value.item()
-        elif isinstance(value, dict):
-            obj[key] = convert_numpy_to_python(value)
-    return obj
+class TelemetryBuffer:
+    """
+    Ring buffer of the most recently stored telemetry, one numpy array per field.
+    Rows are only turned back into dicts when read for an API response.
+    """
+    FLOAT_FIELDS = ("throttle", "fuel_pressure", "fuel_temp", "flow_rate", "score")
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.count = 0  # rows ever written; next slot is count % size
+        self.lock = threading.Lock()
+        self.id = np.empty(size, dtype=object)
+        self.timestamp = np.empty(size, dtype="datetime64[ms]")  # BSON date precision
+        self.rpm = np.empty(size, dtype=np.int32)  # -1 = not an int, see extras
+        self.throttle = np.empty(size, dtype=np.float64)
+        self.fuel_pressure = np.empty(size, dtype=np.float64)
+        self.fuel_temp = np.empty(size, dtype=np.float64)
+        self.flow_rate = np.empty(size, dtype=np.float64)
+        self.anomaly = np.empty(size, dtype=np.int8)  # -1 = not a bool, see extras
+        self.score = np.empty(size, dtype=np.float64)
+        # Float columns hold NaN when the value is not a float (e.g. an int 999 or None), see extras.
+        # Extras: every other field of the document (probable_cause, fault_type, note, ...), or None
+        self.extras = np.empty(size, dtype=object)
+
+    def append(self, doc: dict):
+        # Typed columns only take values of exactly their type, so rows read back unchanged
+        extras = {key: value for key, value in doc.items() if key not in ("_id", "timestamp")}
+        rpm = extras.get("rpm")
+        rpm = extras.pop("rpm") if type(rpm) is int and 0 <= rpm <= np.iinfo(np.int32).max else -1
+        anomaly = extras.pop("anomaly") if type(extras.get("anomaly")) is bool else None
+        floats = {
+            field: extras.pop(field) if type(extras.get(field)) is float else np.nan
+            for field in self.FLOAT_FIELDS
+        }
 
-def simulate_fuel_system():
-    rpm = random.randint(1500, 4000)
-    throttle = round((rpm - 1500) / 25, 2)
-    fuel_pressure = round(2.5 + (rpm / 1000) + random.uniform(-0.2, 0.2), 2)
+        # Truncate to milliseconds like BSON dates do
+        timestamp = to_naive_utc(doc["timestamp"])
+        timestamp = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+        with self.lock:
+            i = self.count % self.size
+            self.id[i] = doc.get("_id")
+            self.timestamp[i] = np.datetime64(timestamp, "ms")
+            self.rpm[i] = rpm
+            self.throttle[i] = floats["throttle"]
+            self.fuel_pressure[i] = floats["fuel_pressure"]
+            self.fuel_temp[i] = floats["fuel_temp"]
+            self.flow_rate[i] = floats["flow_rate"]
+            self.anomaly[i] = -1 if anomaly is None else int(anomaly)
+            self.score[i] = floats["score"]
+            self.extras[i] = extras or None
+            self.count += 1
+
+    def latest(self, limit: int):
+        """Newest `limit` rows by timestamp as dicts (newest first), or None if fewer rows are buffered."""
+        with self.lock:
+            filled = min(self.count, self.size)
+            if limit <= 0 or limit > filled:
+                return None
+            # Rows are not appended in timestamp order (MQTT records are flushed in batches)
+            idx = np.argsort(self.timestamp[:filled], kind="stable")[::-1][:limit]
+            columns = {
+                "_id": self.id[idx].tolist(),
+                "timestamp": self.timestamp[idx].tolist(),
+                "rpm": self.rpm[idx].tolist(),
+                "throttle": self.throttle[idx].tolist(),
+                "fuel_pressure": self.fuel_pressure[idx].tolist(),
+                "fuel_temp": self.fuel_temp[idx].tolist(),
+                "flow_rate": self.flow_rate[idx].tolist(),
+                "anomaly": self.anomaly[idx].tolist(),
+                "score": self.score[idx].tolist(),
+            }
+            extras = self.extras[idx].tolist()
+
+        rows = []
+        for values, extra in zip(zip(*columns.values()), extras):
+            row = dict(zip(columns, values))
+            row["_id"] = str(row["_id"])
+            row["timestamp"] = row["timestamp"].isoformat()
+            # Only emit the fields the stored document had, with their stored types
+            if row["rpm"] == -1:
+                del row["rpm"]
+            if row["anomaly"] == -1:
+                del row["anomaly"]
+            else:
+                row["anomaly"] = bool(row["anomaly"])
+            for field in self.FLOAT_FIELDS:
+                if row[field] != row[field]:  # NaN
+                    del row[field]
+            if extra:
+                row.update(extra)
+            rows.append(row)
+        return rows
+
+telemetry_buffer = TelemetryBuffer()
+
+def simulate_fuel_batch(n):
+    """
+    Vectorized fuel system simulation of `n` samples.
+    Returns column arrays: rpm, throttle, fuel_pressure, fuel_temp, flow_rate (2 decimals).
+    """
+    r = rng.random((7, n))
+    rpm = 1500 + (r[0] * 2501).astype(np.int64)
+    throttle = (rpm - 1500) / 25
+    fuel_pressure = 2.5 + (rpm / 1000) + (r[1] - 0.5) * 0.4
     # Normal temperature calculation
-    fuel_temp = round(20 + (rpm / 200) + random.uniform(-1, 1), 2)
-
-    # Occasionally introduce anomaly (5% chance)
-    if random.random() < 0.1:  # 10% probability
-        if random.choice(["low", "high"]) == "low":
-            fuel_temp = round(random.uniform(-40, -20), 2)  # Abnormally low temp
-        else:
-            fuel_temp = round(random.uniform(56, 80), 2)    # Abnormally high temp
-    flow_rate = round(0.1 * throttle + random.uniform(0, 1), 2)
+    fuel_temp = 20 + (rpm / 200) + (r[2] - 0.5) * 2
+
+    # Occasionally introduce anomaly (10% probability): abnormally low or high temp
+    fuel_temp = np.where(
+        r[3] < 0.1,
+        np.where(r[4] < 0.5, -40 + r[5] * 20, 56 + r[5] * 24),
+        fuel_temp
+    )
+    flow_rate = 0.1 * throttle + r[6]
+
+    # Round the whole batch to 2 decimals in one ufunc call per column
+    return (
+        rpm,
+        np.round(throttle, 2),
+        np.round(fuel_pressure, 2),
+        np.round(fuel_temp, 2),
+        np.round(flow_rate, 2)
+    )
+
+def simulate_fuel_system():
+    # Pop one pre-generated sample, refilling the pool with a vectorized batch when empty
+    with simulation_lock:
+        if not simulated_samples:
+            columns = simulate_fuel_batch(SIMULATION_BATCH_SIZE)
+            simulated_samples.extend(zip(*(col.tolist() for col in columns)))
+        rpm, throttle, fuel_pressure, fuel_temp, flow_rate = simulated_samples.pop()
+
     return {
         "timestamp": datetime.utcnow(),
         "rpm": rpm,
@@ -110,67 +255,145 @@ def simulate_fuel_system():
         "flow_rate": flow_rate
     }
 
-def train_anomaly_model():
-    data = list(collection.find({}, {"_id": 0, "rpm": 1, "fuel_pressure": 1, "fuel_temp": 1, "flow_rate": 1}))
-    if len(data) < 20:
+MODEL_PATH = "anomaly_model.joblib"
+ONNX_MODEL_PATH = "anomaly_model.onnx"
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def export_onnx_model(model, model_path, onnx_path):
+    # Export for ONNX Runtime inference (float32 input, outputs: label, scores),
+    # tagged with the joblib hash so it is only ever used with this model
+    onx = convert_sklearn(
+        model,
+        initial_types=[("X", FloatTensorType([None, 4]))],
+        target_opset={"": 15, "ai.onnx.ml": 3}
+    )
+    meta = onx.metadata_props.add()
+    meta.key = "joblib_sha256"
+    meta.value = file_sha256(model_path)
+    with open(onnx_path, "wb") as f:
+        f.write(onx.SerializeToString())
+
+def fit_anomaly_model(X):
+    model = IsolationForest(n_estimators=100, contamination=0.05)
+    model.fit(X)
+
+    # Write both artifacts to temp files and only swap them in once written
+    model_tmp = MODEL_PATH + ".tmp"
+    onnx_tmp = ONNX_MODEL_PATH + ".tmp"
+    try:
+        dump(model, model_tmp)
+
+        # ONNX is an optional accelerator: an export failure must not block the new model
+        exported = False
+        if convert_sklearn is not None:
+            try:
+                export_onnx_model(model, model_tmp, onnx_tmp)
+                exported = True
+            except Exception as e:
+                print(" ONNX export failed, using scikit-learn inference:", str(e))
+
+        os.replace(model_tmp, MODEL_PATH)
+        if exported:
+            os.replace(onnx_tmp, ONNX_MODEL_PATH)
+        elif os.path.exists(ONNX_MODEL_PATH):
+            os.remove(ONNX_MODEL_PATH)  # stale export of a previous model
+    finally:
+        for path in (model_tmp, onnx_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+
+async def train_anomaly_model():
+    n = await collection.count_documents({})
+    if n < 20:
         print(" Not enough data to train model. Insert at least 20 telemetry records.")
         return
-    df = pd.DataFrame(data)
-    model = IsolationForest(n_estimators=100, contamination=0.05)
-    model.fit(df)
-    dump(model, "anomaly_model.joblib")
+
+    # Fill a preallocated float32 matrix straight from the cursor (no list/DataFrame copy)
+    X = np.empty((n, 4), dtype=np.float32)
+    rows = 0
+    cursor = collection.find({}, {"_id": 0, "rpm": 1, "fuel_pressure": 1, "fuel_temp": 1, "flow_rate": 1}).limit(n).batch_size(5000)
+    async for doc in cursor:
+        X[rows] = (doc["rpm"], doc["fuel_pressure"], doc["fuel_temp"], doc["flow_rate"])
+        rows += 1
+    X = X[:rows]
+
+    # Fitting is CPU-bound; keep it off the event loop
+    await asyncio.to_thread(fit_anomaly_model, X)
     print(" Model trained and saved.")
 
-# Uncomment this line to train when needed
-#train_anomaly_model()
+# Train when needed via POST /retrain
 
 try:
-    model = load("anomaly_model.joblib")
+    model = load(MODEL_PATH)
     print(" Anomaly detection model loaded.")
 except:
     model = None
-    print(" Model not found. Train first using train_anomaly_model().")
+    print(" Model not found. Train first using POST /retrain.")
+
+def load_onnx_session():
+    if ort is None or model is None or not os.path.exists(ONNX_MODEL_PATH):
+        return None
+    session = ort.InferenceSession(ONNX_MODEL_PATH, providers=["CPUExecutionProvider"])
+    # Only use the export that was saved together with the loaded joblib model
+    if session.get_modelmeta().custom_metadata_map.get("joblib_sha256") != file_sha256(MODEL_PATH):
+        print(" ONNX model does not match anomaly_model.joblib, ignoring it.")
+        return None
+    return session
 
-def inject_fault(telemetry: dict, fault_type: str) -> dict:
-    if fault_type == "injector_clog":
-        telemetry["flow_rate"] *= 0.3  # Reduced flow
-    elif fault_type == "sensor_failure":
-        telemetry["fuel_temp"] = 999  # Unreasonably high
-    elif fault_type == "fuel_leak":
-        telemetry["fuel_pressure"] -= 2  # Pressure drop
-    elif fault_type == "rpm_surge":
-        telemetry["rpm"] += 2000  # Abnormal RPM
-        telemetry["throttle"] = round((telemetry["rpm"] - 1500) / 25, 2)
-    elif fault_type == "throttle_spike":
-        telemetry["throttle"] = 100
-        telemetry["flow_rate"] = round(10 + random.uniform(0, 2), 2)
+try:
+    onnx_session = load_onnx_session()
+except Exception as e:
+    onnx_session = None
+    print(" ONNX model failed to load:", str(e))
+if onnx_session:
+    print(" ONNX anomaly model loaded.")
+else:
+    print(" Using scikit-learn inference.")
+
+fault_injectors = {
+    "injector_clog": lambda t: {**t, "flow_rate": t["flow_rate"] * 0.3},  # Reduced flow
+    "sensor_failure": lambda t: {**t, "fuel_temp": 999},  # Unreasonably high
+    "fuel_leak": lambda t: {**t, "fuel_pressure": t["fuel_pressure"] - 2},  # Pressure drop
+    # Abnormal RPM (+2000), throttle recomputed from the surged RPM
+    "rpm_surge": lambda t: {**t, "rpm": t["rpm"] + 2000, "throttle": round((t["rpm"] + 2000 - 1500) / 25, 2)},
+    "throttle_spike": lambda t: {**t, "throttle": 100, "flow_rate": round(10 + rng.random() * 2, 2)},
     # Add more faults as needed
-    else:
-        telemetry["note"] = " Unknown fault type  no effect"
-    return telemetry
+}
 
-def infer_probable_cause(telemetry: dict) -> str:
-    rpm = telemetry["rpm"]
-    fuel_pressure = telemetry["fuel_pressure"]
-    fuel_temp = telemetry["fuel_temp"]
-    flow_rate = telemetry["flow_rate"]
-
-    if flow_rate < 2 and fuel_pressure > 4:
-        return "Fuel injector clog (low flow rate)"
-    elif fuel_temp > 56:
-        return "Overheating sensor or coolant failure"
-    elif fuel_temp < -20:
-        return " sensor breakdown or coolant failure"
-    elif fuel_pressure < 2:
-        return "Possible fuel leak or pump failure"
-    elif fuel_pressure > 4:
-        return "Possible fuel leak or pump failure"
-    elif rpm > 5000:
-        return "Abnormal RPM surge  throttle malfunction"
-    elif throttle := telemetry.get("throttle", 0) > 90 and flow_rate > 8:
-        return "Throttle stuck open  excessive fuel injection"
-    else:
-        return "Anomaly detected, cause unknown"
+def unknown_fault(telemetry: dict) -> dict:
+    return {**telemetry, "note": " Unknown fault type  no effect"}
+
+def inject_fault(telemetry: dict, fault_type: str) -> dict:
+    return fault_injectors.get(fault_type, unknown_fault)(telemetry)
+
+def classify_causes(X: np.ndarray, throttle: np.ndarray) -> np.ndarray:
+    """
+    Classify probable causes for a batch of anomalous samples in one pass.
+    X columns: rpm, fuel_pressure, fuel_temp, flow_rate. First matching rule wins.
+    """
+    rpm, fuel_pressure, fuel_temp, flow_rate = X.T
+    conditions = [
+        (flow_rate < 2) & (fuel_pressure > 4),
+        fuel_temp > 56,
+        fuel_temp < -20,
+        fuel_pressure < 2,
+        fuel_pressure > 4,
+        rpm > 5000,
+        (throttle > 90) & (flow_rate > 8),
+    ]
+    causes = [
+        "Fuel injector clog (low flow rate)",
+        "Overheating sensor or coolant failure",
+        " sensor breakdown or coolant failure",
+        "Possible fuel leak or pump failure",
+        "Possible fuel leak or pump failure",
+        "Abnormal RPM surge  throttle malfunction",
+        "Throttle stuck open  excessive fuel injection",
+    ]
+    return np.select(conditions, causes, default="Anomaly detected, cause unknown")
 
 def infer_safety_measures(cause):
     recommendations = {
@@ -189,18 +412,24 @@ def infer_safety_measures(cause):
     return recommendations.get(cause, "⚠️ Follow standard emergency procedures. Refer to flight manual.")
 
 
-def estimate_rul(anomaly_timestamps, observation_window_days=30):
+def to_naive_utc(ts):
+    """Normalize a stored timestamp (BSON date or legacy ISO string) to naive UTC."""
+    if not isinstance(ts, datetime):
+        ts = datetime.fromisoformat(ts)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+def estimate_rul(first_anomaly, last_anomaly, total_anomalies, observation_window_days=30):
     """
     Estimate RUL in days based on anomaly frequency and trends.
     More anomalies = shorter RUL.
     """
-    if not anomaly_timestamps:
+    if not total_anomalies:
         return "🚀 Component operating normally. No critical failure predicted."
 
-    total_anomalies = len(anomaly_timestamps)
-    
     # Days since first anomaly in observation window
-    days_covered = max(1, (anomaly_timestamps[-1] - anomaly_timestamps[0]).days)
+    days_covered = max(1, (last_anomaly - first_anomaly).days)
 
     avg_days_between_anomalies = days_covered / total_anomalies
 
@@ -210,79 +439,248 @@ def estimate_rul(anomaly_timestamps, observation_window_days=30):
     return estimated_rul
 
 
-# MQTT Publisher Thread with anomaly detection
-def mqtt_publish_loop():
-    mqtt_client.connect(BROKER, PORT)
-    print(f" Connected to MQTT Broker at {BROKER}")
-    
-    while True:
-        telemetry = simulate_fuel_system()
-
-        # Add UTC timestamp
-        telemetry["timestamp"] = datetime.now(timezone.utc)
-
-        # 🧠 Anomaly prediction if model is loaded
-        if model:
-            features = [[
-                telemetry["rpm"],
-                telemetry["fuel_pressure"],
-                telemetry["fuel_temp"],
-                telemetry["flow_rate"]
-            ]]
-            pred = model.predict(features)[0]
-            score = model.decision_function(features)[0]
-
-            telemetry["anomaly"] = bool(pred == -1)
-            telemetry["score"] = float(score)
-
-            # 🛑 Add cause only if anomaly detected
-            if telemetry["anomaly"]:
-                telemetry["probable_cause"] = infer_probable_cause(telemetry)
-        else:
-            telemetry["anomaly"] = None
-            telemetry["score"] = None
-
-        # 📡 MQTT payload (cleaned for external systems)
-        payload = json.dumps({
-            "rpm": telemetry["rpm"],
-            "throttle": telemetry["throttle"],
-            "fuel_pressure": telemetry["fuel_pressure"],
-            "fuel_temp": telemetry["fuel_temp"],
-            "flow_rate": telemetry["flow_rate"]
-        })
+async def detect_anomaly(telemetry: dict) -> dict:
+    """
+    Queue a telemetry sample for batched inference and wait until scored.
+    Sets `anomaly` and `score` (and `probable_cause` for anomalies) on the telemetry dict in place.
+    Re-raises any error from scoring the batch at the caller.
+    """
+    row = (
+        telemetry["rpm"],
+        telemetry["fuel_pressure"],
+        telemetry["fuel_temp"],
+        telemetry["flow_rate"]
+    )
+    done = asyncio.get_running_loop().create_future()
+    inference_queue.put((telemetry, row, done))
+    await done
+    return telemetry
 
-        mqtt_client.publish(TOPIC, payload)
+def resolve_future(future, error=None):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
 
-        # 💾 Store full record in MongoDB
-        collection.insert_one(jsonable_encoder(telemetry))
+# Inference Thread: drains pending samples and scores them in one call
+def inference_batch_loop():
+    while True:
+        batch = [inference_queue.get()]
+        while len(batch) < INFERENCE_BATCH_SIZE:
+            try:
+                batch.append(inference_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        error = None
+        try:
+            # Single float32 conversion per batch, shared by scoring and cause classification
+            X = np.array([row for _, row, _ in batch], dtype=np.float32)
+            if onnx_session:
+                # "scores" output is the decision_function
+                _, scores = onnx_session.run(None, {"X": X})
+                scores = scores.ravel()
+            else:
+                # One tree traversal: decision_function = score_samples - offset_, predict = decision < 0
+                with parallel_backend("threading", n_jobs=-1):
+                    scores = model.score_samples(X) - model.offset_
+
+            for (telemetry, _, _), score in zip(batch, scores.tolist()):
+                telemetry["anomaly"] = score < 0
+                telemetry["score"] = score
+
+            # 🛑 Classify causes for all anomalies of the batch at once
+            anomalous = np.flatnonzero(scores < 0)
+            if anomalous.size:
+                throttle = np.array([batch[i][0].get("throttle", 0) for i in anomalous], dtype=np.float32)
+                for i, cause in zip(anomalous, classify_causes(X[anomalous], throttle).tolist()):
+                    batch[i][0]["probable_cause"] = cause
+        except Exception as e:
+            print(" Batch inference failed:", str(e))
+            error = e
+        finally:
+            # Failures are raised at each waiter's own call site
+            for _, _, done in batch:
+                done.get_loop().call_soon_threadsafe(resolve_future, done, error)
+
+async def store_telemetry(telemetry: dict):
+    # Insert a copy so the caller's dict (often returned as the response) has no ObjectId
+    doc = dict(telemetry)
+    result = await collection.insert_one(doc)
+    telemetry_buffer.append(doc)
+    return result
+
+async def flush_pending_docs():
+    if not pending_docs:
+        return
+    docs = pending_docs[:]
+    pending_docs.clear()
 
-        print(" Published to MQTT and stored in MongoDB:", telemetry)
-        time.sleep(10)
+    retry = []     # transient failure: keep for the next flush
+    rejected = []  # permanent failure: can never be stored
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except asyncio.CancelledError:
+        # Put the in-flight records back for the shutdown flush; any that did reach
+        # MongoDB come back as duplicate keys there and count as stored
+        pending_docs[:0] = docs
+        raise
+    except BulkWriteError as e:
+        # Unordered: every record was attempted. Per-document write errors (validation etc.)
+        # are permanent; duplicate keys were stored by an earlier attempt.
+        rejected_idx = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+        rejected = [docs[i] for i in sorted(rejected_idx)]
+        print(" Telemetry flush partially failed:", str(e))
+    except ConnectionFailure as e:
+        # Network errors, timeouts and server selection failures
+        retry = docs
+        print(" Telemetry flush failed, will retry:", str(e))
+    except Exception as e:
+        rejected = docs
+        print(" Telemetry flush failed:", str(e))
+
+    if rejected:
+        print(f" Discarded {len(rejected)} telemetry records MongoDB rejected.")
+    unsaved_ids = {id(doc) for doc in retry + rejected}
+    for doc in docs:
+        if id(doc) not in unsaved_ids:
+            telemetry_buffer.append(doc)
+    print(f" Stored {len(docs) - len(unsaved_ids)} telemetry records in MongoDB.")
+
+    # Keep transiently failed records for the next flush, bounded
+    pending_docs[:0] = retry
+    if len(pending_docs) > TELEMETRY_MAX_PENDING:
+        dropped = len(pending_docs) - TELEMETRY_MAX_PENDING
+        del pending_docs[:dropped]
+        print(f" Dropped {dropped} unsaved telemetry records.")
+
+def on_mqtt_connect(client, userdata, flags, rc):
+    print(f" Connected to MQTT Broker at {BROKER} (rc={rc})")
+
+# MQTT Publisher task with anomaly detection, scheduled on the app's event loop
+async def mqtt_publish_loop():
+    loop = asyncio.get_running_loop()
+    last_flush = time.monotonic()
+    next_tick = loop.time()
+    
+    while True:
+        try:
+            telemetry = simulate_fuel_system()
+
+            # Add UTC timestamp
+            telemetry["timestamp"] = datetime.now(timezone.utc)
+
+            # 🧠 Anomaly prediction if model is loaded
+            if model:
+                # 🛑 Cause is added only if anomaly detected
+                await detect_anomaly(telemetry)
+            else:
+                telemetry["anomaly"] = None
+                telemetry["score"] = None
+
+            # 📡 MQTT payload (cleaned for external systems)
+            payload = json.dumps({
+                "rpm": telemetry["rpm"],
+                "throttle": telemetry["throttle"],
+                "fuel_pressure": telemetry["fuel_pressure"],
+                "fuel_temp": telemetry["fuel_temp"],
+                "flow_rate": telemetry["flow_rate"]
+            })
+
+            # Non-blocking: the network loop thread started by loop_start() sends it
+            mqtt_client.publish(TOPIC, payload)
+
+            # 💾 Buffer full record for a bulk MongoDB write
+            pending_docs.append(telemetry)
+            print(" Published to MQTT:", telemetry)
+
+            if (
+                len(pending_docs) >= TELEMETRY_FLUSH_SIZE
+                or time.monotonic() - last_flush >= TELEMETRY_FLUSH_INTERVAL
+            ):
+                await flush_pending_docs()
+                last_flush = time.monotonic()
+        except Exception:
+            # Log and keep ticking; one failed tick must not end the publisher
+            print(" Telemetry tick failed:")
+            traceback.print_exc()
+
+        # Fixed cadence on the monotonic loop clock, independent of work time
+        next_tick += PUBLISH_INTERVAL
+        delay = next_tick - loop.time()
+        if delay < 0:
+            # Fell behind (stall): restart the cadence rather than firing catch-up ticks
+            next_tick = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+
+
+def on_publisher_done(task):
+    # Surface an unexpected exit right away instead of at garbage collection
+    if not task.cancelled() and task.exception():
+        print(" MQTT publisher stopped:", repr(task.exception()))
+
+
+async def create_indexes():
+    # Anomaly queries filter on `anomaly` and sort by newest timestamp
+    await collection.create_index([("anomaly", 1), ("timestamp", -1)])
+    await collection.create_index([("timestamp", -1)])
+    await collection_tanks.create_index("tank_id", unique=True)
 
+@app.on_event("startup")
+async def setup_indexes():
+    try:
+        await create_indexes()
+        print(" MongoDB indexes ensured.")
+    except Exception as e:
+        print(" Index creation failed:", str(e))
 
 # Start MQTT publishing in background
 @app.on_event("startup")
-def start_background_mqtt():
-    threading.Thread(target=mqtt_publish_loop, daemon=True).start()
+async def start_background_mqtt():
+    threading.Thread(target=inference_batch_loop, daemon=True).start()
+    mqtt_client.on_connect = on_mqtt_connect
+    mqtt_client.connect_async(BROKER, PORT)
+    mqtt_client.loop_start()  # handles keepalives and reconnects
+    app.state.mqtt_task = asyncio.create_task(mqtt_publish_loop())
+    app.state.mqtt_task.add_done_callback(on_publisher_done)
+
+# Stop publishing and store any buffered telemetry before exit
+@app.on_event("shutdown")
+async def stop_background_mqtt():
+    app.state.mqtt_task.cancel()
+    try:
+        await app.state.mqtt_task
+    except asyncio.CancelledError:
+        pass
+    mqtt_client.loop_stop()
+    await flush_pending_docs()
 
 # FastAPI endpoint
 @app.get("/telemetry")
-def get_telemetry():
+async def get_telemetry():
     data = simulate_fuel_system()
-    result = collection.insert_one(jsonable_encoder(data))
+    result = await store_telemetry(data)
     print(" Inserted via API - ID:", result.inserted_id)
     # Convert timestamp for JSON response
     data["timestamp"] = data["timestamp"].isoformat()
     return data
 
 @app.get("/telemetry/history")
-def get_telemetry_history(limit: int = 20):
+async def get_telemetry_history(limit: int = 20):
     """
-    Get the latest `limit` telemetry logs from MongoDB.
+    Get the latest `limit` telemetry logs, from the in-process buffer when it
+    holds enough rows, otherwise from MongoDB.
     Default: 20 most recent entries.
     """
+    logs = telemetry_buffer.latest(limit)
+    if logs is not None:
+        return logs
+
     # Sort by newest and limit
-    logs = list(collection.find().sort("timestamp", -1).limit(limit))
+    logs = await collection.find().sort("timestamp", -1).limit(limit).to_list(length=None)
 
     # Convert Mongo ObjectId and datetime to serializable format
     for log in logs:
@@ -292,27 +690,27 @@ def get_telemetry_history(limit: int = 20):
     return logs
 
 @app.post("/initialize-tanks")
-def initialize_tanks():
+async def initialize_tanks():
     tanks = [
         {"tank_id": "TANK-1", "status": "Active"},
         {"tank_id": "TANK-2", "status": "Active"},
         {"tank_id": "TANK-3", "status": "Active"},
     ]
-    collection_tanks.delete_many({})  # Clear previous tanks (optional)
-    collection_tanks.insert_many(tanks)
+    await collection_tanks.delete_many({})  # Clear previous tanks (optional)
+    await collection_tanks.insert_many(tanks)
     return {"message": "✅ 3 fuel tanks initialized successfully."}
 
 @app.get("/tanks")
-def get_all_tanks():
-    tanks = list(collection_tanks.find({}, {"_id": 0}))
+async def get_all_tanks():
+    tanks = await collection_tanks.find({}, {"_id": 0}).to_list(length=None)
     return {"fuel_tanks": tanks}
 
 @app.post("/tanks/update-status")
-def update_tank_status(update: TankStatusUpdate):
+async def update_tank_status(update: TankStatusUpdate):
     if update.status not in ["Active", "Inactive", "Under Maintenance"]:
         return {"error": "❌ Invalid status. Use Active, Inactive, or Under Maintenance."}
 
-    result = collection_tanks.update_one(
+    result = await collection_tanks.update_one(
         {"tank_id": update.tank_id},
         {"$set": {"status": update.status}}
     )
@@ -323,38 +721,21 @@ def update_tank_status(update: TankStatusUpdate):
     return {"message": f"✅ {update.tank_id} status updated to {update.status}."}
 
 @app.post("/predict")
-def predict_anomaly():
+async def predict_anomaly():
     if not model:
         return {"error": "Anomaly detection model not found. Train it first."}
 
     telemetry = simulate_fuel_system()
     telemetry["timestamp"] = datetime.utcnow()
 
-    features = [[
-        telemetry["rpm"],
-        telemetry["fuel_pressure"],
-        telemetry["fuel_temp"],
-        telemetry["flow_rate"],
-    ]]
-
-    # ✅ Ensure native Python types
-    pred = model.predict(features)[0]
-    score = model.decision_function(features)[0]
-    telemetry["anomaly"] = bool(pred == -1)          # <-- Fix numpy.bool_
-    telemetry["score"] = float(score)                 # <-- Fix numpy.float64
-
-    # ✅ Add probable cause only if anomaly
-    if telemetry["anomaly"]:
-        telemetry["probable_cause"] = infer_probable_cause(telemetry)
-
-    # ✅ Convert remaining numpy values (if any)
-    telemetry = convert_numpy_to_python(telemetry)
+    # ✅ Scored as native bool/float by the inference batcher, with probable cause only if anomaly
+    await detect_anomaly(telemetry)
 
     print("Telemetry to be inserted into DB:", telemetry)
 
 
     # ✅ Insert into MongoDB
-    collection.insert_one(jsonable_encoder(telemetry))
+    await store_telemetry(telemetry)
 
     # ✅ Format timestamp for return
     telemetry["timestamp"] = telemetry["timestamp"].isoformat()
@@ -367,28 +748,17 @@ def predict_anomaly():
     }
 
 @app.post("/safety-recommendation")
-def safety_recommendation():
+async def safety_recommendation():
     if not model:
         return {"error": "Anomaly detection model not available. Train it first."}
 
     telemetry = simulate_fuel_system()
     telemetry["timestamp"] = datetime.utcnow()
 
-    features = [[
-        telemetry["rpm"],
-        telemetry["fuel_pressure"],
-        telemetry["fuel_temp"],
-        telemetry["flow_rate"]
-    ]]
-
-    pred = model.predict(features)[0]
-    score = model.decision_function(features)[0]
-
-    telemetry["anomaly"] = bool(pred == -1)
-    telemetry["score"] = float(score)
+    await detect_anomaly(telemetry)
 
     if telemetry["anomaly"]:
-        cause = infer_probable_cause(telemetry)
+        cause = telemetry["probable_cause"]
         safety = infer_safety_measures(cause)
     else:
         cause = "Normal operation"
@@ -397,7 +767,7 @@ def safety_recommendation():
     # Optional: log this result
     telemetry["probable_cause"] = cause
     telemetry["safety_measures"] = safety
-    collection.insert_one(jsonable_encoder(telemetry))
+    await store_telemetry(telemetry)
 
     return {
         "anomaly_detected": telemetry["anomaly"],
@@ -407,74 +777,86 @@ def safety_recommendation():
     }
 
 @app.get("/maintenance-suggestions")
-def maintenance_suggestions():
-    # Fetch last 100 anomaly logs (customizable)
-    logs = collection.find({"anomaly": True}).sort("timestamp", -1).limit(100)
-    
-    causes = [log.get("probable_cause", "Unknown") for log in logs]
-    cause_counter = Counter(causes)
-    
-    if not causes:
+async def maintenance_suggestions():
+    # Count probable causes over the last 100 anomaly logs (customizable) server-side
+    cursor = await collection.aggregate([
+        {"$match": {"anomaly": True}},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": 100},
+        {"$sortByCount": "$probable_cause"}
+    ])
+    cause_counts = await cursor.to_list(length=None)
+
+    if not cause_counts:
         return {
             "message": "✅ No recent anomalies detected. Routine maintenance recommended."
         }
     
     # Prepare suggestions
     suggestions = []
-    for cause, count in cause_counter.most_common():
+    for row in cause_counts:
+        cause = row["_id"] or "Unknown"
         suggestion = fault_to_maintenance.get(cause, "⚙️ General system inspection advised.")
         suggestions.append({
             "probable_cause": cause,
-            "occurrences": count,
+            "occurrences": row["count"],
             "recommended_action": suggestion
         })
     
     return {
         "maintenance_suggestions": suggestions,
-        "total_anomalies_analyzed": sum(cause_counter.values())
+        "total_anomalies_analyzed": sum(row["count"] for row in cause_counts)
     }
 
 @app.get("/predictive-maintenance")
-def predictive_maintenance_estimator():
-    # Fetch recent 100 anomalies (or any count you prefer)
-    logs = collection.find({"anomaly": True}).sort("timestamp", 1).limit(100)
-
-    anomaly_timestamps = []
-    for log in logs:
-        ts = log.get("timestamp")
-        if ts:
-            anomaly_timestamps.append(ts)
-
-    if not anomaly_timestamps:
+async def predictive_maintenance_estimator():
+    # Reduce the first 100 anomalies (or any count you prefer) to first/last/count server-side
+    cursor = await collection.aggregate([
+        {"$match": {"anomaly": True, "timestamp": {"$ne": None}}},
+        {"$sort": {"timestamp": 1}},
+        {"$limit": 100},
+        {"$group": {
+            "_id": None,
+            "first": {"$min": "$timestamp"},
+            "last": {"$max": "$timestamp"},
+            "n": {"$sum": 1}
+        }}
+    ])
+    summaries = await cursor.to_list(length=1)
+    summary = summaries[0] if summaries else None
+
+    if not summary:
         rul = "🚀 Component operating normally. No critical failure predicted."
+        total_anomalies = 0
     else:
-        # Convert MongoDB timestamps to datetime objects
-        anomaly_timestamps = [ts if isinstance(ts, datetime) else datetime.fromisoformat(ts) for ts in anomaly_timestamps]
-        rul = estimate_rul(anomaly_timestamps)
+        total_anomalies = summary["n"]
+        rul = estimate_rul(to_naive_utc(summary["first"]), to_naive_utc(summary["last"]), total_anomalies)
 
     return {
         "remaining_useful_life_days_estimated": rul,
-        "total_anomalies_analyzed": len(anomaly_timestamps)
+        "total_anomalies_analyzed": total_anomalies
     }
 
 
 
 @app.get("/alerts")
-def get_anomaly_alerts(limit: int = Query(10, description="Number of recent anomalies to return")):
+async def get_anomaly_alerts(limit: int = Query(10, description="Number of recent anomalies to return")):
     """
     Returns the latest `limit` anomaly records where anomaly == True.
     Useful for alerting or dashboard display.
     """
     # Fetch only anomaly==True records, sorted by latest timestamp
-    anomalies = list(collection.find(
+    cursor = collection.find(
         {"anomaly": True}
-    ).sort("timestamp", -1).limit(limit))
+    ).sort("timestamp", -1).limit(limit)
 
     # Convert ObjectId and timestamp to string for JSON serialization
-    for doc in anomalies:
+    anomalies = []
+    async for doc in cursor:
         doc["_id"] = str(doc["_id"])
         if isinstance(doc.get("timestamp"), datetime):
             doc["timestamp"] = doc["timestamp"].isoformat()
+        anomalies.append(doc)
 
     return {
         "count": len(anomalies),
@@ -482,14 +864,14 @@ def get_anomaly_alerts(limit: int = Query(10, description="Number of recent anom
     }
 
 @app.post("/retrain")
-def retrain_model():
-    train_anomaly_model()
+async def retrain_model():
+    await train_anomaly_model()
     return {"message": "Model retrained and saved."}
 
 @app.post("/alert/send")
-def send_latest_alert():
+async def send_latest_alert():
     # Fetch latest anomaly
-    latest = collection.find_one({"anomaly": True}, sort=[("timestamp", -1)])
+    latest = await collection.find_one({"anomaly": True}, sort=[("timestamp", -1)])
     if not latest:
         return {"message": "No anomaly found in the database."}
 
@@ -507,22 +889,25 @@ def send_latest_alert():
 
     # ✅ Send Email via SendGrid
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
+        if sendgrid_client is None:
+            raise RuntimeError("SENDGRID_API_KEY not configured")
         email = Mail(
             from_email=SENDGRID_SENDER,
             to_emails=ALERT_RECEIVER_EMAIL,
             subject=" Helicopter Fuel Anomaly Detected",
             plain_text_content=message_body
         )
-        sg.send(email)
+        await asyncio.to_thread(sendgrid_client.send, email)
         print(" Email sent.")
     except Exception as e:
         print(" Email failed:", str(e))
 
     # ✅ Send SMS via Twilio
     try:
-        twilio_client = TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        twilio_client.messages.create(
+        if twilio_client is None:
+            raise RuntimeError("TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN not configured")
+        await asyncio.to_thread(
+            twilio_client.messages.create,
             body=message_body,
             from_=TWILIO_PHONE_NUMBER,
             to=ALERT_RECEIVER_PHONE
@@ -537,7 +922,7 @@ def send_latest_alert():
     }
 
 @app.post("/simulate-fault")
-def simulate_fault(fault: FaultRequest):
+async def simulate_fault(fault: FaultRequest):
     telemetry = simulate_fuel_system()
 
     # Inject fault (your logic assumed)
@@ -547,22 +932,10 @@ def simulate_fault(fault: FaultRequest):
 
     # Run anomaly detection
     if model:
-        features = [[
-            telemetry["rpm"],
-            telemetry["fuel_pressure"],
-            telemetry["fuel_temp"],
-            telemetry["flow_rate"]
-        ]]
-        pred = model.predict(features)[0]
-        score = model.decision_function(features)[0]
-        telemetry["anomaly"] = bool(pred == -1)  # ✅ convert np.bool_ to native bool
-        telemetry["score"] = float(score)        # ✅ convert np.float64 to native float
-
-    # ✅ Convert remaining numpy values
-    telemetry = convert_numpy_to_python(telemetry)
+        await detect_anomaly(telemetry)
 
     # ✅ Store in MongoDB
-    collection.insert_one(jsonable_encoder(telemetry))
+    await store_telemetry(telemetry)
 
     return {
         "fault_type": fault.type,
@@ -571,8 +944,41 @@ def simulate_fault(fault: FaultRequest):
         "telemetry": telemetry
     }
 
+def anomalies_to_table(logs):
+    """
+    Build an Arrow table from Mongo documents, one column per field seen in any document.
+    Timestamps (legacy ISO strings and BSON dates) are normalized to naive UTC datetimes.
+    Other columns with mixed types are written as text.
+    """
+    columns = list(dict.fromkeys(key for log in logs for key in log))
+    arrays = []
+    for column in columns:
+        values = [log.get(column) for log in logs]
+        if column == "timestamp":
+            try:
+                values = [None if v is None else to_naive_utc(v) for v in values]
+            except (TypeError, ValueError):
+                pass  # unparseable legacy value: fall through to the text fallback
+        try:
+            arrays.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array(
+                [None if v is None else v.isoformat() if isinstance(v, datetime) else str(v) for v in values],
+                type=pa.string()
+            ))
+    return pa.Table.from_arrays(arrays, names=columns)
+
+def anomalies_to_json_response(logs):
+    # Encoding and rendering both happen in the constructor
+    return JSONResponse(content=jsonable_encoder(logs))
+
+def anomalies_to_csv(logs):
+    sink = pa.BufferOutputStream()
+    pa_csv.write_csv(anomalies_to_table(logs), sink)
+    return sink.getvalue().to_pybytes()
+
 @app.get("/telemetry/export")
-def export_anomalies(
+async def export_anomalies(
     format: str = Query("csv", description="Export format: csv or json"),
     start_date: str = Query(None, description="Start date in YYYY-MM-DD"),
     end_date: str = Query(None, description="End date in YYYY-MM-DD")
@@ -580,6 +986,9 @@ def export_anomalies(
     """
     Export anomalous telemetry data as CSV or JSON.
     Optional date filtering: ?start_date=2025-07-01&end_date=2025-07-02
+    CSV is written by pyarrow: header and string fields are double-quoted,
+    booleans are lowercase true/false, timestamps are naive UTC written as
+    "YYYY-MM-DD HH:MM:SS.ffffff" (space separator).
     """
     query = {"anomaly": True}
 
@@ -601,22 +1010,19 @@ def export_anomalies(
             return JSONResponse(status_code=400, content={"error": "Invalid end_date format. Use YYYY-MM-DD"})
 
     # Fetch from MongoDB
-    anomaly_logs = list(collection.find(query, {"_id": 0}))
+    anomaly_logs = await collection.find(query, {"_id": 0}).to_list(length=None)
 
     if not anomaly_logs:
         return JSONResponse(status_code=404, content={"message": "No anomalies found in the specified date range."})
 
-    df = pd.DataFrame(anomaly_logs)
-
+    # Serialization is CPU-bound; keep it off the event loop
     if format == "json":
-        return JSONResponse(content=df.to_dict(orient="records"))
+        return await asyncio.to_thread(anomalies_to_json_response, anomaly_logs)
 
     elif format == "csv":
-        csv_stream = StringIO()
-        df.to_csv(csv_stream, index=False)
-        csv_stream.seek(0)
+        csv_bytes = await asyncio.to_thread(anomalies_to_csv, anomaly_logs)
         return StreamingResponse(
-            csv_stream,
+            BytesIO(csv_bytes),
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=anomalies.csv"}
         )